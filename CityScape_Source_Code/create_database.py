@@ -1,20 +1,62 @@
 # create_database.py
 from langchain_community.document_loaders import TextLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain.schema import Document
 from langchain_openai import OpenAIEmbeddings
 from langchain_community.vectorstores import Chroma
 import openai 
+import chromadb
+import tiktoken
 from dotenv import load_dotenv
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+import asyncio
 import os
+import re
 import shutil
+import uuid
 
 # Load environment variables
 load_dotenv()
 openai.api_key = os.environ['OPENAI_API_KEY']
 
 CHROMA_PATH = "chroma"
+QUERY_CACHE_FILE = os.path.join(CHROMA_PATH, "query_cache.pkl")
+# Set CHROMA_HOST to write to a Chroma server (`chroma run --path ./chroma`)
+# instead of opening the persistent directory in-process.
+CHROMA_HOST = os.environ.get('CHROMA_HOST')
+CHROMA_PORT = int(os.environ.get('CHROMA_PORT', '8000'))
 DATA_FILE = "data/nyc/nyc.txt"
+# Must match the collection langchain's Chroma wrapper opens in query_data.py.
+COLLECTION_NAME = Chroma._LANGCHAIN_DEFAULT_COLLECTION_NAME
+EMBEDDING_ENCODING = "cl100k_base"
+CHUNK_TOKENS = 400
+CHUNK_OVERLAP_TOKENS = 40
+# Documents longer than this are cut at paragraph breaks before the recursive
+# splitter sees them, and splitting moves to worker processes once there are
+# enough documents to pay for starting them.
+LARGE_DOCUMENT_CHARS = 20000
+PARALLEL_SPLIT_MIN_DOCUMENTS = 64
+# OpenAI limits each input to 8191 tokens and each request to 300k tokens
+# across its inputs; EMBEDDING_BATCH_SIZE matches OpenAIEmbeddings' chunk_size.
+EMBEDDING_INPUT_TOKENS = 8191
+EMBEDDING_BATCH_TOKENS = 300000
+EMBEDDING_BATCH_SIZE = 1000
+MAX_CONCURRENT_EMBEDDING_BATCHES = 4
+UPLOAD_BATCH_SIZE = 1000
+MAX_CONCURRENT_UPLOADS = 8
+VENUE_SEPARATOR = re.compile(r'\n=+\n')
+PARAGRAPH_SEPARATOR = re.compile(r'\n\n+')
+VENUE_FIELD_PATTERN = re.compile(r'^(Name|Location|Type|Rating|Budget):\s*(.+)$', re.M)
+# Must match query_data.py, so venue tags line up with stored cuisine preferences.
+CUISINE_PATTERN = re.compile(
+    r"\b(mexican|indian|italian|thai|japanese|chinese|moroccan|halal|vegan|vegetarian|"
+    r"taco|tacos|bagel|bagels|sushi|pizza|burger|burgers|ice cream|coffee|breakfast)\b"
+)
+CUISINE_ALIASES = {
+    'taco': 'mexican', 'tacos': 'mexican', 'sushi': 'japanese', 'pizza': 'italian',
+    'vegan': 'vegetarian', 'bagels': 'bagel', 'burgers': 'burger'
+}
 
 def main():
     # Check if data file exists
@@ -32,12 +74,13 @@ def generate_data_store():
         print("No documents were loaded. Cannot proceed.")
         return
         
-    chunks = split_text(documents)
+    venues = split_venues(documents)
+    chunks = split_text(venues)
     if not chunks:
         print("No chunks were created. Cannot proceed.")
         return
         
-    save_to_chroma(chunks)
+    asyncio.run(save_to_chroma(chunks))
 
 def load_documents():
     try:
@@ -50,14 +93,88 @@ def load_documents():
         print(f"Error loading documents: {str(e)}")
         return []
 
-def split_text(documents: list[Document]):
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=500,
-        chunk_overlap=50,
-        length_function=len,
+def parse_venue_fields(text: str):
+    fields = {}
+    for key, value in VENUE_FIELD_PATTERN.findall(text):
+        fields.setdefault(key.lower(), value.strip())
+    # "Taco restaurant" -> "mexican", matching how cuisine preferences are
+    # stored, so retrieval can filter on it.
+    cuisine = CUISINE_PATTERN.search(fields.get('type', '').lower())
+    if cuisine:
+        fields['cuisine'] = CUISINE_ALIASES.get(cuisine.group(1), cuisine.group(1))
+    return fields
+
+def split_venues(documents: list[Document]):
+    # Split each file into one document per venue so that every chunk carries
+    # the venue's Name/Location/Type/Rating/Budget as metadata.
+    venues = []
+    for document in documents:
+        for text in VENUE_SEPARATOR.split(document.page_content):
+            if not text.strip():
+                continue
+            metadata = {**document.metadata, **parse_venue_fields(text)}
+            venues.append(Document(page_content=text.strip(), metadata=metadata))
+    print(f"Split {len(documents)} documents into {len(venues)} venues.")
+    return venues
+
+def split_paragraphs(document: Document):
+    text = document.page_content
+    if len(text) <= LARGE_DOCUMENT_CHARS:
+        return [document]
+
+    # Sections are slices of the original text, so separators are kept as-is,
+    # and each records its offset so split_document can keep start_index
+    # relative to the whole document.
+    paragraphs = []
+    paragraph_start = 0
+    for separator in PARAGRAPH_SEPARATOR.finditer(text):
+        paragraphs.append((paragraph_start, separator.start()))
+        paragraph_start = separator.end()
+    paragraphs.append((paragraph_start, len(text)))
+
+    sections = []
+    section_start, section_end = paragraphs[0]
+    for paragraph_start, paragraph_end in paragraphs[1:]:
+        if paragraph_end - section_start > LARGE_DOCUMENT_CHARS:
+            sections.append((section_start, section_end))
+            section_start = paragraph_start
+        section_end = paragraph_end
+    sections.append((section_start, section_end))
+
+    return [
+        Document(
+            page_content=text[section_start:section_end],
+            metadata={**document.metadata, 'section_offset': section_start}
+        )
+        for section_start, section_end in sections
+    ]
+
+@lru_cache(maxsize=1)
+def get_text_splitter():
+    return RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+        encoding_name=EMBEDDING_ENCODING,
+        chunk_size=CHUNK_TOKENS,
+        chunk_overlap=CHUNK_OVERLAP_TOKENS,
         add_start_index=True,
+        keep_separator=False,
     )
-    chunks = text_splitter.split_documents(documents)
+
+def split_document(document: Document):
+    chunks = get_text_splitter().split_documents([document])
+    encoding = tiktoken.get_encoding(EMBEDDING_ENCODING)
+    for chunk in chunks:
+        chunk.metadata['start_index'] += chunk.metadata.pop('section_offset', 0)
+        chunk.metadata['n_tokens'] = len(encoding.encode(chunk.page_content))
+    return chunks
+
+def split_text(documents: list[Document]):
+    sections = [section for document in documents for section in split_paragraphs(document)]
+    if len(sections) >= PARALLEL_SPLIT_MIN_DOCUMENTS:
+        with ProcessPoolExecutor() as executor:
+            split_sections = list(executor.map(split_document, sections, chunksize=16))
+    else:
+        split_sections = [split_document(section) for section in sections]
+    chunks = [chunk for section_chunks in split_sections for chunk in section_chunks]
     print(f"Split {len(documents)} documents into {len(chunks)} chunks.")
     
     if chunks:
@@ -68,19 +185,104 @@ def split_text(documents: list[Document]):
     
     return chunks
 
-def save_to_chroma(chunks: list[Document]):
+def pack_batches(chunks: list[Document]):
+    # Sort by token count and pack greedily so each embedding request carries
+    # as many chunks as fit within the per-request token and input limits.
+    batches = []
+    batch = []
+    batch_tokens = 0
+    for chunk in sorted(chunks, key=lambda chunk: chunk.metadata['n_tokens']):
+        tokens = chunk.metadata['n_tokens']
+        if tokens > EMBEDDING_INPUT_TOKENS:
+            print(f"Skipping chunk of {tokens} tokens from {chunk.metadata.get('source')}: "
+                  f"over the {EMBEDDING_INPUT_TOKENS}-token embedding input limit.")
+            continue
+        if batch and (batch_tokens + tokens > EMBEDDING_BATCH_TOKENS or
+                      len(batch) >= EMBEDDING_BATCH_SIZE):
+            batches.append(batch)
+            batch = []
+            batch_tokens = 0
+        batch.append(chunk)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+async def embed_batches(batches: list[list[Document]], embeddings: OpenAIEmbeddings):
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_EMBEDDING_BATCHES)
+
+    async def embed_batch(batch):
+        async with semaphore:
+            return await embeddings.aembed_documents([chunk.page_content for chunk in batch])
+
+    return await asyncio.gather(*(embed_batch(batch) for batch in batches))
+
+def upload_batches(documents: list[Document], vectors: list[list[float]]):
+    for start in range(0, len(documents), UPLOAD_BATCH_SIZE):
+        upload = documents[start:start + UPLOAD_BATCH_SIZE]
+        yield dict(
+            ids=[str(uuid.uuid4()) for _ in upload],
+            documents=[chunk.page_content for chunk in upload],
+            metadatas=[chunk.metadata for chunk in upload],
+            embeddings=vectors[start:start + UPLOAD_BATCH_SIZE]
+        )
+
+def save_to_local_chroma(documents: list[Document], vectors: list[list[float]]):
+    if os.path.exists(CHROMA_PATH):
+        shutil.rmtree(CHROMA_PATH)
+
+    client = chromadb.PersistentClient(path=CHROMA_PATH)
+    collection = client.get_or_create_collection(COLLECTION_NAME)
+    for batch in upload_batches(documents, vectors):
+        collection.add(**batch)
+
+async def save_to_chroma_server(documents: list[Document], vectors: list[list[float]]):
+    # The server's data directory is not ours to delete, but a cached query
+    # result from a previous build would now be stale.
+    if os.path.exists(QUERY_CACHE_FILE):
+        os.remove(QUERY_CACHE_FILE)
+
+    client = await chromadb.AsyncHttpClient(host=CHROMA_HOST, port=CHROMA_PORT)
+    # Deleting a missing collection comes back from the server as a generic
+    # Exception rather than ValueError, so check before deleting.
+    existing = [collection.name for collection in await client.list_collections()]
+    if COLLECTION_NAME in existing:
+        await client.delete_collection(COLLECTION_NAME)
+    collection = await client.get_or_create_collection(COLLECTION_NAME)
+
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_UPLOADS)
+
+    async def upload(batch):
+        async with semaphore:
+            await collection.add(**batch)
+
+    await asyncio.gather(*(upload(batch) for batch in upload_batches(documents, vectors)))
+
+async def save_to_chroma(chunks: list[Document]):
     if not chunks:
         print("No chunks to save to Chroma.")
         return
-        
-    if os.path.exists(CHROMA_PATH):
-        shutil.rmtree(CHROMA_PATH)
 
-    db = Chroma.from_documents(
-        chunks, OpenAIEmbeddings(), persist_directory=CHROMA_PATH
+    embeddings = OpenAIEmbeddings(
+        chunk_size=EMBEDDING_BATCH_SIZE,
+        max_retries=6
     )
-    db.persist()
-    print(f"Saved {len(chunks)} chunks to {CHROMA_PATH}.")
+    batches = pack_batches(chunks)
+    print(f"Embedding {len(chunks)} chunks in {len(batches)} batches.")
+    batch_vectors = await embed_batches(batches, embeddings)
+
+    documents = [chunk for batch in batches for chunk in batch]
+    if not documents:
+        print("No chunks fit the embedding input limit. Cannot proceed.")
+        return
+    vectors = [vector for vectors in batch_vectors for vector in vectors]
+
+    if CHROMA_HOST:
+        await save_to_chroma_server(documents, vectors)
+        print(f"Saved {len(documents)} chunks to Chroma at {CHROMA_HOST}:{CHROMA_PORT}.")
+    else:
+        save_to_local_chroma(documents, vectors)
+        print(f"Saved {len(documents)} chunks to {CHROMA_PATH}.")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,11 +1,26 @@
 import warnings
+import asyncio
+import chromadb
 from langchain_community.vectorstores import Chroma
+from langchain.schema import Document
 from langchain_openai import OpenAIEmbeddings
 from langchain_openai import ChatOpenAI
 from langchain.prompts import ChatPromptTemplate
+from langchain_core.rate_limiters import InMemoryRateLimiter
 from dotenv import load_dotenv
+import httpx
 import os
-import json
+import re
+import math
+import sys
+import threading
+import orjson
+import aiofiles
+import pickle
+import hashlib
+import numpy as np
+from collections import OrderedDict
+from contextlib import aclosing, suppress
 from datetime import datetime
 from typing import Dict, List, Optional
 
@@ -13,8 +28,103 @@ warnings.filterwarnings("ignore", category=DeprecationWarning)
 load_dotenv()
 
 CHROMA_PATH = "chroma"
+CHROMA_HOST = os.environ.get('CHROMA_HOST')
+CHROMA_PORT = int(os.environ.get('CHROMA_PORT', '8000'))
 PREFERENCES_FILE = "user_preferences.json"
 PLAN_FILE = "nyc_plan.json"
+# Lives inside the Chroma directory so rebuilding the database discards it.
+QUERY_CACHE_FILE = os.path.join(CHROMA_PATH, "query_cache.pkl")
+RETRIEVAL_K = 3
+RELEVANCE_THRESHOLD = 0.7
+MMR_FETCH_K = 20
+MMR_LAMBDA = 0.5
+FLUSH_INTERVAL_SECONDS = 5
+VENUE_FIELDS = ['name', 'location', 'type', 'rating', 'budget']
+VENUE_FIELD_PATTERN = re.compile(r'^(Name|Location|Type|Rating|Budget):\s*(.+)$', re.M)
+MAX_CONCURRENT_LLM_CALLS = 4
+MAX_CONCURRENT_RETRIEVALS = 8
+REQUEST_TIMEOUT_SECONDS = 30.0
+MAX_RETRIES = 3
+# Tune to the request-per-minute limit of the OpenAI account tier in use.
+REQUESTS_PER_SECOND = 8
+RATE_LIMIT_BURST = 16
+CLASSIFICATION_CACHE_SIZE = 512
+EMBED_CACHE_SIZE = 1024
+RETRIEVAL_CACHE_SIZE = 256
+SEMANTIC_CACHE_SIZE = 128
+SEMANTIC_CACHE_THRESHOLD = 0.95
+QUERY_CACHE_VERSION = 3
+FOLLOW_UP_CATEGORIES = ['Location/Navigation', 'Price/Budget Inquiry', 'Details/Information']
+PREFERENCE_CATEGORY = 'Preference Statement'
+CATEGORY_CONFIDENCE_THRESHOLD = 0.75
+# ada-002 similarities bunch high, so an absolute cutoff alone lets ambiguous
+# queries through; the best category must also beat the runner-up by this much.
+CATEGORY_MARGIN_THRESHOLD = 0.03
+FOOD_CATEGORIES = ['Food and Dining', 'Generic Lunch/Dinner Suggestion']
+PREFERENCE_PATTERN = re.compile(r"\bi (?:really )?(?:like|love|prefer|enjoy) (\w+) (?:food|cuisine|restaurants?|dishes)\b")
+CUISINE_PATTERN = re.compile(
+    r"\b(mexican|indian|italian|thai|japanese|chinese|moroccan|halal|vegan|vegetarian|"
+    r"taco|tacos|bagel|bagels|sushi|pizza|burger|burgers|ice cream|coffee|breakfast)\b"
+)
+# Must match create_database.py, which tags each venue with the canonical name.
+CUISINE_ALIASES = {
+    'taco': 'mexican', 'tacos': 'mexican', 'sushi': 'japanese', 'pizza': 'italian',
+    'vegan': 'vegetarian', 'bagels': 'bagel', 'burgers': 'burger'
+}
+
+# Example queries per category, embedded once and compared against incoming
+# queries so routing and query enhancement do not need an LLM round trip.
+CATEGORY_EXEMPLARS = {
+    'Food and Dining': [
+        "Where can I find good Mexican food?",
+        "Which cafe has the best pastries?",
+        "Is there a good place for bagels?",
+    ],
+    'Entertainment': [
+        "What fun things can I do today?",
+        "Are there any interesting museums to visit?",
+        "Where can I go for a drink tonight?",
+    ],
+    'Location/Navigation': [
+        "Where is it located?",
+        "How do I get there?",
+        "Which subway stop is closest?",
+    ],
+    'Price/Budget Inquiry': [
+        "How much does it cost?",
+        "Is it expensive?",
+        "What is the price per person?",
+    ],
+    'Comparison': [
+        "Which one is better?",
+        "How does it compare to the other place?",
+    ],
+    'Recommendations': [
+        "What do you recommend in Manhattan?",
+        "Suggest something to do in the city",
+    ],
+    'Details/Information': [
+        "What are the opening hours?",
+        "What is the rating?",
+        "Tell me more about it",
+    ],
+    'Generic Lunch/Dinner Suggestion': [
+        "Where can I grab a quick bite?",
+        "Recommend a restaurant to me",
+        "Where should I get lunch?",
+        "Where should I get dinner?",
+    ],
+    'Plan Management': [
+        "Add this to my plan",
+        "Save this place",
+        "Add it to the list",
+    ],
+    PREFERENCE_CATEGORY: [
+        "I like Mexican food",
+        "I prefer Italian restaurants",
+        "I love Indian cuisine",
+    ],
+}
 
 CLASSIFICATION_PROMPT = """
 Analyze the following user query and classify it into the most appropriate category:
@@ -111,10 +221,15 @@ Provide a focused response that:
 Answer in a clear, direct manner.
 """
 
-DAY_PLAN_PROMPT = """
-Create a logical day itinerary using these venues:
+FINAL_PLAN_PROMPT = """
+Using these venues from the user's NYC travel plan:
 {venues}
 
+First, under the heading "Your NYC Plan", summarize the plan with a bullet point for each venue.
+Include the name, type, location, and budget for each venue.
+
+Then, under the heading "Your Day Plan", create a logical day itinerary using the same venues.
+
 Consider:
 1. Logical order based on location and type
 2. Typical opening hours (assume standard business hours if not specified)
@@ -124,7 +239,7 @@ Consider:
 6. Energy levels throughout the day
 7. Most efficient route through the city
 
-Format the response as a detailed day plan with:
+Format the itinerary as a detailed day plan with:
 - Approximate timing for each venue
 - Brief description of what to do there
 - Logical transitions between places
@@ -136,75 +251,308 @@ If the plan has mostly restaurants, space them out appropriately for meals and s
 Include practical advice about the neighborhood and any insider tips for each stop.
 """
 
+PLAN_SUMMARY_PROMPT = """
+Create a summary of this NYC travel plan. For each venue, mention its key details.
+
+Venues:
+{venues}
+
+Format the response as a clear plan with bullet points for each venue.
+Include the name, type, location, and budget for each venue.
+"""
+
+CLASSIFICATION_TEMPLATE = ChatPromptTemplate.from_template(CLASSIFICATION_PROMPT)
+INITIAL_TEMPLATE = ChatPromptTemplate.from_template(INITIAL_PROMPT_TEMPLATE)
+FOLLOW_UP_TEMPLATE = ChatPromptTemplate.from_template(FOLLOW_UP_PROMPT_TEMPLATE)
+FINAL_PLAN_TEMPLATE = ChatPromptTemplate.from_template(FINAL_PLAN_PROMPT)
+PLAN_SUMMARY_TEMPLATE = ChatPromptTemplate.from_template(PLAN_SUMMARY_PROMPT)
+
+ADD_PHRASES = ('add to plan', 'add it to', 'save this', 'adding it')
+EXIT_COMMANDS = ('exit', 'quit', 'bye', 'done')
+# Inputs matching these are handled in main without any model or embedding call.
+COMMAND_PATTERN = re.compile(r'^(add to plan|add it to .*|save this.*|adding it.*|show plan|exit|quit|bye|done)$', re.I)
+PREFERENCE_STATEMENT_PATTERN = re.compile(r'^i (?:really )?(?:like|prefer|love|enjoy) (\w+) (?:food|cuisine|restaurants?)$', re.I)
+
+def is_add_to_plan_request(query):
+    query = query.lower()
+    return any(phrase in query for phrase in ADD_PHRASES)
+
+def cache_put(cache, key, value, max_size):
+    cache[key] = value
+    cache.move_to_end(key)
+    if len(cache) > max_size:
+        cache.popitem(last=False)
+
+def cache_get(cache, key):
+    if key not in cache:
+        return None
+    cache.move_to_end(key)
+    return cache[key]
+
+def relevance_from_distance(distance):
+    # The conversion langchain applies to Chroma's default l2 distance, so
+    # RELEVANCE_THRESHOLD keeps the meaning it had with
+    # similarity_search_with_relevance_scores.
+    return 1.0 - distance / math.sqrt(2)
+
+async def read_input(prompt):
+    # input() cannot be interrupted, so it runs on a daemon thread rather than
+    # the default executor, which asyncio.run would wait on at shutdown.
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def resolve(result, error):
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def read():
+        try:
+            loop.call_soon_threadsafe(resolve, input(prompt), None)
+        except BaseException as error:
+            loop.call_soon_threadsafe(resolve, None, error)
+
+    threading.Thread(target=read, daemon=True).start()
+    return await future
+
+async def write_atomically(path, data):
+    temp_path = path + '.tmp'
+    try:
+        async with aiofiles.open(temp_path, 'wb') as f:
+            await f.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        with suppress(OSError):
+            os.remove(temp_path)
+        raise
+
 class NYCGuide:
     def __init__(self):
-        self.embedding_function = OpenAIEmbeddings()
-        self.db = Chroma(persist_directory=CHROMA_PATH, embedding_function=self.embedding_function)
-        self.model = ChatOpenAI(temperature=0.7)
+        # One pooled HTTP/2 client for chat and embedding calls keeps
+        # connections to OpenAI warm instead of handshaking per request.
+        self.http_client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+            timeout=REQUEST_TIMEOUT_SECONDS
+        )
+        # Shared by chat and embedding calls so bursts are paced locally
+        # instead of being rejected with 429s and retried.
+        self.rate_limiter = InMemoryRateLimiter(
+            requests_per_second=REQUESTS_PER_SECOND,
+            check_every_n_seconds=0.05,
+            max_bucket_size=RATE_LIMIT_BURST
+        )
+        self.embedding_function = OpenAIEmbeddings(
+            http_async_client=self.http_client,
+            timeout=REQUEST_TIMEOUT_SECONDS,
+            max_retries=MAX_RETRIES
+        )
+        self.db = None
+        self.model = ChatOpenAI(
+            temperature=0.7,
+            streaming=True,
+            http_async_client=self.http_client,
+            timeout=REQUEST_TIMEOUT_SECONDS,
+            max_retries=MAX_RETRIES,
+            rate_limiter=self.rate_limiter
+        )
+        self.llm_semaphore = asyncio.Semaphore(MAX_CONCURRENT_LLM_CALLS)
+        self.retrieval_semaphore = asyncio.Semaphore(MAX_CONCURRENT_RETRIEVALS)
         self.last_response = None
         self.last_context = None
+        self.last_venue = None
         self.last_classification = None
+        self.streamed = False
+        self.classification_cache = OrderedDict()
+        self.semantic_cache_vectors = None
+        self.semantic_cache_classifications = []
+        self.category_vectors = None
+        self.category_labels = []
         self.plan = {"venues": []}
+        self.preferences_dirty = False
+        self.plan_dirty = False
         self.load_preferences()
         self.load_plan()
+        self.load_query_cache()
+        # Opening Chroma and embedding the category examples happen while the
+        # user types their first message; anything needing them awaits this.
+        self.warm_up_task = asyncio.create_task(self.warm_up())
+
+    def open_database(self):
+        if CHROMA_HOST:
+            return Chroma(
+                client=chromadb.HttpClient(host=CHROMA_HOST, port=CHROMA_PORT),
+                embedding_function=self.embedding_function
+            )
+        return Chroma(persist_directory=CHROMA_PATH, embedding_function=self.embedding_function)
+
+    async def warm_up(self):
+        self.db = await asyncio.to_thread(self.open_database)
+        # Embedding the examples also opens the pooled connection to OpenAI.
+        # A failure here is not fatal: the vectors load lazily on first use.
+        try:
+            await self.load_category_vectors()
+        except Exception as e:
+            print(f"Error warming up category classifier: {e}")
 
     def load_preferences(self):
         try:
-            with open(PREFERENCES_FILE, 'r') as f:
-                self.preferences = json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError):
+            with open(PREFERENCES_FILE, 'rb') as f:
+                self.preferences = orjson.loads(f.read())
+        except (FileNotFoundError, orjson.JSONDecodeError):
             self.preferences = {"cuisine": None}
             self.save_preferences()
 
     def save_preferences(self):
-        with open(PREFERENCES_FILE, 'w') as f:
-            json.dump(self.preferences, f)
+        self.preferences_dirty = True
 
     def load_plan(self):
         try:
-            with open(PLAN_FILE, 'r') as f:
-                loaded_plan = json.load(f)
+            with open(PLAN_FILE, 'rb') as f:
+                loaded_plan = orjson.loads(f.read())
                 if isinstance(loaded_plan, dict) and "venues" in loaded_plan:
                     self.plan = loaded_plan
                 else:
                     self.plan = {"venues": []}
-        except (FileNotFoundError, json.JSONDecodeError):
+        except (FileNotFoundError, orjson.JSONDecodeError):
             self.plan = {"venues": []}
             self.save_plan()
+        self.plan_names = {v.get('name', '').strip().lower() for v in self.plan['venues']}
 
     def save_plan(self):
-        with open(PLAN_FILE, 'w') as f:
-            json.dump(self.plan, indent=2, fp=f)
+        self.plan_dirty = True
+
+    async def flush(self):
+        # Saves are debounced: save_* only mark state dirty and this writes it
+        # out, periodically and once more before exit.
+        # A flag is cleared before its write so changes made while the write is
+        # in flight are flushed next time, and set again if the write fails or
+        # is cancelled.
+        if self.preferences_dirty:
+            self.preferences_dirty = False
+            try:
+                await write_atomically(PREFERENCES_FILE, orjson.dumps(self.preferences))
+            except BaseException:
+                self.preferences_dirty = True
+                raise
+        if self.plan_dirty:
+            self.plan_dirty = False
+            try:
+                await write_atomically(PLAN_FILE, orjson.dumps(self.plan, option=orjson.OPT_INDENT_2))
+            except BaseException:
+                self.plan_dirty = True
+                raise
+
+    async def flush_periodically(self):
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL_SECONDS)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Error saving your plan and preferences: {e}")
+
+    def load_query_cache(self):
+        try:
+            with open(QUERY_CACHE_FILE, 'rb') as f:
+                cache = pickle.load(f)
+            if cache.get('version') != QUERY_CACHE_VERSION:
+                raise KeyError('version')
+            # Files written before the caches were bounded keep only their newest entries.
+            self.embed_cache = OrderedDict(list(cache['embeddings'].items())[-EMBED_CACHE_SIZE:])
+            self.retrieval_cache = OrderedDict(list(cache['retrievals'].items())[-RETRIEVAL_CACHE_SIZE:])
+        except Exception:
+            # A missing, truncated or stale cache only costs a few re-embeds.
+            self.embed_cache = OrderedDict()
+            self.retrieval_cache = OrderedDict()
+
+    async def save_query_cache(self):
+        if not os.path.isdir(CHROMA_PATH):
+            return
+        await write_atomically(QUERY_CACHE_FILE, pickle.dumps({
+            'version': QUERY_CACHE_VERSION,
+            'embeddings': self.embed_cache,
+            'retrievals': self.retrieval_cache
+        }))
 
     def update_preference(self, preference_type, value):
         self.preferences[preference_type] = value
         self.save_preferences()
 
-    def extract_venue_info(self, context):
-        extraction_prompt = f"""
-        Extract the following information from this venue description:
-        - Venue Name
-        - Location
-        - Type
-        - Rating
-        - Budget
-        
-        Text: {context}
-        
-        Return only the extracted information in this format:
-        Name: [venue name]
-        Location: [location]
-        Type: [type]
-        Rating: [rating]
-        Budget: [budget]
-        """
-        
-        response = self.model.invoke(extraction_prompt)
+    async def invoke_model(self, prompt):
+        async with self.llm_semaphore:
+            return await self.model.ainvoke(prompt)
+
+    async def embed_query(self, text):
+        key = hashlib.blake2b(text.encode()).digest()
+        vector = cache_get(self.embed_cache, key)
+        if vector is None:
+            # OpenAIEmbeddings has no rate_limiter hook, so take a token here.
+            await self.rate_limiter.aacquire()
+            vector = await self.embedding_function.aembed_query(text)
+            cache_put(self.embed_cache, key, vector, EMBED_CACHE_SIZE)
+        return vector
+
+    def write_stream(self, text):
+        sys.stdout.write(text)
+        sys.stdout.flush()
+        self.streamed = True
+
+    async def stream_model(self, prompt):
+        content = []
+        try:
+            async with self.llm_semaphore, aclosing(self.model.astream(prompt)) as stream:
+                async for chunk in stream:
+                    self.write_stream(chunk.content)
+                    content.append(chunk.content)
+        except Exception:
+            # A stream cut off part way leaves a partial answer on screen; end
+            # its line and clear the flag so the caller's fallback is printed.
+            if self.streamed:
+                print()
+            self.streamed = False
+            raise
+        return "".join(content)
+
+    def search_by_vector(self, vector, k, where):
+        # Searching by vector keeps Chroma from embedding the query a second time.
+        # The closest match's distance is what the relevance threshold applies to;
+        # MMR then picks k varied venues from the nearest MMR_FETCH_K.
+        top = self.db.similarity_search_by_vector_with_relevance_scores(vector, k=1, filter=where)
+        if not top:
+            return [], 0.0
+        docs = self.db.max_marginal_relevance_search_by_vector(
+            vector, k=k, fetch_k=MMR_FETCH_K, lambda_mult=MMR_LAMBDA, filter=where
+        )
+        return docs, relevance_from_distance(top[0][1])
+
+    async def retrieve(self, query, k=RETRIEVAL_K, cuisine=None):
+        key = (hashlib.blake2b(query.encode()).digest(), k, cuisine)
+        cached = cache_get(self.retrieval_cache, key)
+        if cached is None:
+            vector = await self.embed_query(query)
+            await self.warm_up_task
+            async with self.retrieval_semaphore:
+                docs, score = await asyncio.to_thread(
+                    self.search_by_vector, vector, k, {'cuisine': cuisine} if cuisine else None
+                )
+            # Cached as plain tuples so the pickle does not depend on the
+            # Document class of the installed langchain version.
+            cached = ([(doc.page_content, doc.metadata or {}) for doc in docs], score)
+            cache_put(self.retrieval_cache, key, cached, RETRIEVAL_CACHE_SIZE)
+
+        contents, score = cached
+        return [Document(page_content=content, metadata=metadata) for content, metadata in contents], score
+
+    def extract_venue_info(self, context, metadata=None):
+        if metadata and metadata.get('name'):
+            return {field: metadata.get(field, 'Not specified') for field in VENUE_FIELDS}
+
         info = {}
-        for line in response.content.split('\n'):
-            if ':' in line:
-                key, value = line.split(':', 1)
-                info[key.strip().lower()] = value.strip()
+        for key, value in VENUE_FIELD_PATTERN.findall(context):
+            info.setdefault(key.lower(), value.strip())
         return info
 
     def add_to_plan(self):
@@ -212,10 +560,10 @@ class NYCGuide:
             return "No venue to add to plan. Please ask about a place first."
         
         try:
-            venue_info = self.extract_venue_info(self.last_context)
+            venue_info = self.extract_venue_info(self.last_context, self.last_venue)
+            name = venue_info.get('name', '').strip().lower()
             
-            if any(v.get('name', '').lower() == venue_info.get('name', '').lower() 
-                  for v in self.plan.get('venues', [])):
+            if name in self.plan_names:
                 return f"{venue_info.get('name', 'This venue')} is already in your plan!"
             
             venue_entry = {
@@ -228,6 +576,7 @@ class NYCGuide:
                 self.plan['venues'] = []
                 
             self.plan['venues'].append(venue_entry)
+            self.plan_names.add(name)
             self.save_plan()
             
             return f"Added {venue_info.get('name', 'the venue')} to your NYC plan!"
@@ -236,70 +585,151 @@ class NYCGuide:
             print(f"Error adding to plan: {e}")
             return "Sorry, I couldn't add this place to your plan. Please try asking about the venue again."
 
-    def get_plan_summary(self):
-        if not self.plan.get('venues', []):
-            return "Your NYC plan is empty! Ask me about places you'd like to visit."
-        
-        venues_for_summary = []
-        for venue in self.plan.get('venues', []):
-            venue_summary = {
+    def venues_for_prompt(self, venues):
+        # Compact JSON: indentation only adds prompt tokens.
+        return orjson.dumps([
+            {
                 'name': venue.get('name', 'Unknown Venue'),
                 'type': venue.get('type', 'Unknown Type'),
                 'location': venue.get('location', 'Location not specified'),
                 'budget': venue.get('budget', 'Budget not specified')
             }
-            venues_for_summary.append(venue_summary)
+            for venue in venues
+        ]).decode()
 
-        summary_prompt = f"""
-        Create a summary of this NYC travel plan. For each venue, mention its key details.
-        
-        Venues:
-        {json.dumps(venues_for_summary, indent=2)}
-        
-        Format the response as a clear plan with bullet points for each venue.
-        Include the name, type, location, and budget for each venue.
-        """
+    async def get_plan_summary(self):
+        venues = self.plan.get('venues', [])
+        if not venues:
+            return "Your NYC plan is empty! Ask me about places you'd like to visit."
+
+        summary_prompt = PLAN_SUMMARY_TEMPLATE.format(venues=self.venues_for_prompt(venues))
         
         try:
-            response = self.model.invoke(summary_prompt)
-            return response.content
+            return await self.stream_model(summary_prompt)
         except Exception as e:
             print(f"Error generating summary: {e}")
             return "Sorry, I couldn't generate your plan summary. You have " + \
-                   f"{len(self.plan.get('venues', []))} venues saved."
+                   f"{len(venues)} venues saved."
 
-    def generate_day_plan(self):
-        if not self.plan.get('venues', []):
+    async def generate_final_plan(self):
+        # The exit summary and the day itinerary share the same venue list, so
+        # one streamed call produces both instead of two round trips.
+        venues = self.plan.get('venues', [])
+        if not venues:
             return "No venues saved in your plan!"
-        
-        venues_for_planning = []
-        for venue in self.plan.get('venues', []):
-            venue_summary = {
-                'name': venue.get('name', 'Unknown Venue'),
-                'type': venue.get('type', 'Unknown Type'),
-                'location': venue.get('location', 'Location not specified'),
-                'budget': venue.get('budget', 'Budget not specified'),
-            }
-            venues_for_planning.append(venue_summary)
 
-        day_plan_prompt = ChatPromptTemplate.from_template(DAY_PLAN_PROMPT)
-        prompt = day_plan_prompt.format(
-            venues=json.dumps(venues_for_planning, indent=2)
-        )
+        prompt = FINAL_PLAN_TEMPLATE.format(venues=self.venues_for_prompt(venues))
 
         try:
-            response = self.model.invoke(prompt)
-            return "\n🗽 Here's a suggested day plan with your saved places:\n\n" + response.content
+            return await self.stream_model(prompt)
         except Exception as e:
-            print(f"Error generating day plan: {e}")
-            return "Sorry, I couldn't generate a day plan with your saved venues."
+            print(f"Error generating final plan: {e}")
+            return "Sorry, I couldn't generate a day plan with your saved venues. You have " + \
+                   f"{len(venues)} venues saved."
+
+    def cache_classification(self, key, classification):
+        cache_put(self.classification_cache, key, classification, CLASSIFICATION_CACHE_SIZE)
+
+    def find_similar_classification(self, vector):
+        if self.semantic_cache_vectors is None:
+            return None
+        similarities = self.semantic_cache_vectors @ vector
+        best = int(np.argmax(similarities))
+        if similarities[best] > SEMANTIC_CACHE_THRESHOLD:
+            return self.semantic_cache_classifications[best]
+        return None
+
+    def add_semantic_classification(self, vector, classification):
+        if self.semantic_cache_vectors is None:
+            self.semantic_cache_vectors = vector[np.newaxis, :]
+        else:
+            self.semantic_cache_vectors = np.vstack([self.semantic_cache_vectors, vector])
+        self.semantic_cache_classifications.append(classification)
+        if len(self.semantic_cache_classifications) > SEMANTIC_CACHE_SIZE:
+            self.semantic_cache_vectors = self.semantic_cache_vectors[1:]
+            self.semantic_cache_classifications.pop(0)
+
+    async def load_category_vectors(self):
+        if self.category_vectors is not None:
+            return
+        labels = []
+        exemplars = []
+        for category, examples in CATEGORY_EXEMPLARS.items():
+            labels.extend([category] * len(examples))
+            exemplars.extend(examples)
+        await self.rate_limiter.aacquire()
+        vectors = np.array(await self.embedding_function.aembed_documents(exemplars))
+        self.category_vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+        self.category_labels = labels
+
+    async def classify_with_embeddings(self, query):
+        key = query.strip().lower()
+        vector = np.array(await self.embed_query(key))
+        await self.warm_up_task
+        await self.load_category_vectors()
+        similarities = self.category_vectors @ (vector / np.linalg.norm(vector))
+        best = int(np.argmax(similarities))
+        category = self.category_labels[best]
+        runner_up = max(
+            (score for label, score in zip(self.category_labels, similarities) if label != category),
+            default=-1.0
+        )
 
-    def classify_query(self, query):
-        prompt_template = ChatPromptTemplate.from_template(CLASSIFICATION_PROMPT)
-        prompt = prompt_template.format(query=query)
-        response = self.model.invoke(prompt)
-        
-        lines = response.content.strip().split('\n')
+        classification = {
+            'category': category,
+            'intent': query,
+            'key_terms': '',
+            'is_preference': 'no',
+            'preference_type': 'none',
+            'preference_value': 'none',
+            'is_generic_food_question': 'no',
+            'confidence': float(similarities[best]),
+            'margin': float(similarities[best] - runner_up)
+        }
+
+        preference = PREFERENCE_PATTERN.search(key)
+        # Non-cuisine words ("street food") leave is_preference unset so
+        # classify_query falls back to the LLM for them.
+        if (category == PREFERENCE_CATEGORY and preference and
+                CUISINE_PATTERN.fullmatch(preference.group(1))):
+            classification['is_preference'] = 'yes'
+            classification['preference_type'] = 'cuisine'
+            classification['preference_value'] = preference.group(1)
+        elif category in FOOD_CATEGORIES and not CUISINE_PATTERN.search(key):
+            classification['is_generic_food_question'] = 'yes'
+        return classification
+
+    async def classify_query(self, query):
+        key = query.strip().lower()
+        cached = cache_get(self.classification_cache, key)
+        if cached is not None:
+            return cached
+
+        classification = await self.classify_with_embeddings(query)
+        confident = (classification['confidence'] >= CATEGORY_CONFIDENCE_THRESHOLD and
+                     classification['margin'] >= CATEGORY_MARGIN_THRESHOLD)
+        if not confident or (classification['category'] == PREFERENCE_CATEGORY and
+                             classification['is_preference'] != 'yes'):
+            vector = np.array(await self.embed_query(key))
+            vector /= np.linalg.norm(vector)
+            classification = self.find_similar_classification(vector)
+            if classification is None:
+                classification = await self.classify_with_model(query)
+                # Preference statements differ only in the preferred value, so they
+                # must never be answered from a near-duplicate.
+                if classification['is_preference'] != 'yes':
+                    self.add_semantic_classification(vector, classification)
+
+        self.cache_classification(key, classification)
+        return classification
+
+    async def classify_with_model(self, query):
+        prompt = CLASSIFICATION_TEMPLATE.format(query=query)
+        response = await self.invoke_model(prompt)
+        return self.parse_classification(response.content)
+
+    def parse_classification(self, text):
+        lines = text.strip().split('\n')
         classification = {
             'category': '',
             'intent': '',
@@ -328,75 +758,95 @@ class NYCGuide:
 
         return classification
 
-    def get_recommendations(self, query):
-        if any(phrase in query.lower() for phrase in ['add to plan', 'add it to', 'save this', 'adding it']):
+    async def get_recommendations(self, query):
+        if is_add_to_plan_request(query):
             return self.add_to_plan()
 
-        classification = self.classify_query(query)
-        self.last_classification = classification
-
-        if classification['is_preference'] == 'yes' and classification['preference_type'] == 'cuisine':
-            self.update_preference('cuisine', classification['preference_value'])
-            return f"I've noted that you like {classification['preference_value']} food. I'll remember this for future recommendations!"
-
-        enhanced_query = query
-        if (classification['category'] in ['Food and Dining', 'Recommendations'] and 
-            self.preferences['cuisine'] and classification['is_generic_food_question'] == 'yes'):
-            enhanced_query = f"{query} {self.preferences['cuisine']} restaurant"
+        # The query embedding is shared by classification and retrieval, so
+        # compute it once before running both. classify_query only reaches the
+        # LLM when the embedding match is not confident.
+        await self.embed_query(query.strip().lower())
+        pre_classification, (docs, score) = await asyncio.gather(
+            self.classify_query(query),
+            self.retrieve(query)
+        )
 
-        results = self.db.similarity_search_with_relevance_scores(enhanced_query, k=4)
-        if len(results) == 0 or results[0][1] < 0.7:
+        if (pre_classification['is_preference'] == 'yes' and
+                pre_classification['preference_type'] == 'cuisine'):
+            return self.note_cuisine_preference(pre_classification['preference_value'])
+
+        cuisine = self.preferences['cuisine']
+        if cuisine and pre_classification['is_generic_food_question'] == 'yes':
+            enhanced_query = f"{query} {cuisine} restaurant"
+            docs, score = await self.retrieve(enhanced_query, cuisine=cuisine)
+            # Databases built before venues were tagged with a cuisine, or a
+            # cuisine the guide has no close venue for, fall back to plain search.
+            if not docs or score < RELEVANCE_THRESHOLD:
+                docs, score = await self.retrieve(enhanced_query)
+        if not docs or score < RELEVANCE_THRESHOLD:
             return "I couldn't find any matching venues for that request. Could you try rephrasing or being more specific?"
 
-        self.last_context = "\n\n---\n\n".join([doc.page_content for doc, _score in results])
-        
-        preferences_to_pass = self.preferences if classification['category'] in ['Food and Dining', 'Recommendations'] and classification['is_generic_food_question'] == 'yes' else {"cuisine": None}
+        self.last_context = "\n\n---\n\n".join([doc.page_content for doc in docs])
+        self.last_venue = docs[0].metadata
+        self.last_classification = pre_classification
+
+        preferences_to_pass = self.preferences if pre_classification['is_generic_food_question'] == 'yes' else {"cuisine": None}
 
-        prompt_template = ChatPromptTemplate.from_template(INITIAL_PROMPT_TEMPLATE)
-        prompt = prompt_template.format(
+        prompt = INITIAL_TEMPLATE.format(
             context=self.last_context,
             question=query,
-            category=classification['category'],
-            intent=classification['intent'],
-            key_terms=classification['key_terms'],
-            preferences=json.dumps(preferences_to_pass)
+            category=pre_classification['category'],
+            intent=pre_classification['intent'],
+            key_terms=pre_classification['key_terms'],
+            preferences=orjson.dumps(preferences_to_pass).decode()
         )
 
-        response = self.model.invoke(prompt)
-        self.last_response = response.content
-        return response.content
+        self.last_response = await self.stream_model(prompt)
+        return self.last_response
 
-    def handle_follow_up(self, question):
-        if any(phrase in question.lower() for phrase in ['add to plan', 'add it to', 'save this', 'adding it']):
+    def note_cuisine_preference(self, cuisine):
+        self.update_preference('cuisine', CUISINE_ALIASES.get(cuisine, cuisine))
+        return f"I've noted that you like {cuisine} food. I'll remember this for future recommendations!"
+
+    async def handle_follow_up(self, question):
+        if is_add_to_plan_request(question):
             return self.add_to_plan()
 
         if not self.last_response or not self.last_context:
             return "I don't have any previous recommendations to reference. Please ask about a specific place first."
 
-        classification = self.classify_query(question)
+        classification = await self.classify_query(question)
         
-        prompt_template = ChatPromptTemplate.from_template(FOLLOW_UP_PROMPT_TEMPLATE)
-        prompt = prompt_template.format(
+        prompt = FOLLOW_UP_TEMPLATE.format(
             context=self.last_context,
             previous_response=self.last_response,
             question=question,
             category=classification['category'],
             intent=classification['intent'],
-            preferences=json.dumps(self.preferences)
+            preferences=orjson.dumps(self.preferences).decode()
         )
 
-        response = self.model.invoke(prompt)
-        return response.content
+        return await self.stream_model(prompt)
 
-    def is_follow_up_question(self, question):
-        if any(phrase in question.lower() for phrase in ['add to plan', 'add it to', 'save this', 'adding it']):
+    async def is_follow_up_question(self, question):
+        if is_add_to_plan_request(question):
             return True
             
-        classification = self.classify_query(question)
-        follow_up_categories = ['Location/Navigation', 'Price/Budget Inquiry', 'Details/Information']
-        return classification['category'] in follow_up_categories and self.last_response is not None
-
-def main():
+        if self.last_response is None:
+            return False
+        classification = await self.classify_query(question)
+        return classification['category'] in FOLLOW_UP_CATEGORIES
+
+async def print_response(guide, response, prefix=""):
+    # Streamed answers are already on screen by the time the call returns.
+    guide.streamed = False
+    print(prefix, end="", flush=True)
+    response = await response if asyncio.iscoroutine(response) else response
+    if not guide.streamed:
+        print(response, end="")
+    print()
+
+async def main():
     guide = NYCGuide()
     print("\n🗽 Welcome to NYC Explorer! Let's explore New York City today.")
     print("Tell me what you'd like to do or where you'd like to go!")
@@ -409,30 +859,53 @@ def main():
     print("\nType 'show plan' to see your saved places")
     print("Type 'exit' to quit\n")
 
-    while True:
-        user_input = input("\nYou: ").strip().lower()
+    flusher = asyncio.create_task(guide.flush_periodically())
+    try:
+        while True:
+            user_input = (await read_input("\nYou: ")).strip().lower()
         
-        if user_input in ['quit', 'exit', 'bye', 'done']:
-            if guide.plan.get('venues', []):
-                print("\nHere's your final NYC plan:")
-                print(guide.get_plan_summary())
-                print("\nLet me organize these places into a day plan for you...")
-                print(guide.generate_day_plan())
-            print("\nThanks for exploring NYC! I'll remember your preferences and plan for next time! 👋")
-            break
+            command = COMMAND_PATTERN.match(user_input)
+            preference = PREFERENCE_STATEMENT_PATTERN.match(user_input)
+            # "I like street food" or "I prefer cheap restaurants" are not
+            # cuisines; leave those to the classifier.
+            if preference and not CUISINE_PATTERN.fullmatch(preference.group(1).lower()):
+                preference = None
+
+            if command and command.group(1) in EXIT_COMMANDS:
+                if guide.plan.get('venues', []):
+                    print("\n🗽 Here's your final NYC plan, organized into a day with your saved places:\n")
+                    await print_response(guide, guide.generate_final_plan())
+                print("\nThanks for exploring NYC! I'll remember your preferences and plan for next time! 👋")
+                break
             
-        if user_input == 'show plan':
-            print("\nNYC Guide: " + guide.get_plan_summary() + "\n")
-            continue
+            if command and command.group(1) == 'show plan':
+                await print_response(guide, guide.get_plan_summary(), "\nNYC Guide: ")
+                print()
+                continue
         
-        if user_input == 'add to plan':
-            response = guide.add_to_plan()
-        elif guide.is_follow_up_question(user_input):
-            response = guide.handle_follow_up(user_input)
-        else:
-            response = guide.get_recommendations(user_input)
+            if command:
+                response = guide.add_to_plan()
+            elif preference:
+                response = guide.note_cuisine_preference(preference.group(1))
+            elif await guide.is_follow_up_question(user_input):
+                response = guide.handle_follow_up(user_input)
+            else:
+                response = guide.get_recommendations(user_input)
             
-        print("\nNYC Guide: " + response + "\n")
+            await print_response(guide, response, "\nNYC Guide: ")
+            print()
+    finally:
+        flusher.cancel()
+        with suppress(asyncio.CancelledError):
+            await flusher
+        await guide.flush()
+        await guide.save_query_cache()
+        # Retrieve a failed warm-up's exception, or stop one still running,
+        # before its HTTP client goes away.
+        guide.warm_up_task.cancel()
+        with suppress(asyncio.CancelledError, Exception):
+            await guide.warm_up_task
+        await guide.http_client.aclose()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    asyncio.run(main())
\ No newline at end of file